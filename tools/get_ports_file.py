@@ -1,5 +1,20 @@
-import requests
+import collections
+import concurrent.futures
+import copy
 import json
+import mmap
+import os
+
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SESSION = requests.Session()
+
+CACHE_FILE = '.ports_json_cache'
 
 repos = {
     "main": "https://github.com/PortsMaster/PortMaster-New/releases/latest/download/ports.json",
@@ -10,9 +25,11 @@ def build_requirements(port_info, runtimes_info):
     """
     Matches hardware capabilities to port requirements.
     """
-    requirements = port_info.get('attr', {}).get('reqs', [])[:]
+    attr = port_info.get('attr', {})
 
-    runtime = port_info.get('attr', {}).get('runtime', None)
+    requirements = attr.get('reqs', [])[:]
+
+    runtime = attr.get('runtime', None)
 
     if runtime is not None:
         if not runtime.endswith('.squashfs'):
@@ -21,7 +38,7 @@ def build_requirements(port_info, runtimes_info):
         requirements.append('|'.join(runtimes_info.get(runtime, [])))
 
     else:
-        arch = port_info.get('attr', {}).get('arch', [])
+        arch = attr.get('arch', [])
 
         if isinstance(arch, list) and len(arch) > 0:
             requirements.append('|'.join(arch))
@@ -67,6 +84,16 @@ def match_requirements(capabilities, requirements):
 def device_cfw_tag(port_info, device_info, runtimes_info):
     match_all = False
 
+    ## The requirements only depend on the port, build them once not per device/cfw.
+    requirements = build_requirements(port_info, runtimes_info)
+
+    ## No requirements matches every cfw, skip the per-cfw checks entirely.
+    if len(requirements) == 0:
+        port_info["attr"]["avail"] = [
+            f"{next(iter(cfw_info.values()))['device']}:ALL"
+            for cfw_info in device_info.values()]
+        return
+
     avail_dev = []
     for device_name, cfw_info in device_info.items():
 
@@ -75,8 +102,6 @@ def device_cfw_tag(port_info, device_info, runtimes_info):
         for cfw_name, device_cfw_info in cfw_info.items():
             device_tag = f"{device_cfw_info['device']}:{device_cfw_info['name']}"
 
-            requirements = build_requirements(port_info, runtimes_info)
-
             if not match_requirements(device_cfw_info['capabilities'], requirements):
                 match_cfw = False
                 match_all = False
@@ -95,12 +120,72 @@ def device_cfw_tag(port_info, device_info, runtimes_info):
     port_info["attr"]["avail"] = avail_dev
 
 
+def load_json(file_name):
+    if orjson is not None:
+        with open(file_name, 'rb') as fh:
+            try:
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return orjson.loads(memoryview(mm))
+
+            except ValueError:
+                ## Empty files cannot be mmapped.
+                return orjson.loads(fh.read())
+
+    with open(file_name, 'r') as fh:
+        return json.load(fh)
+
+
+def dump_json(obj, file_name):
+    ## Deliberately stdlib json: orjson writes raw UTF-8 where json escapes
+    ## non-ASCII, which would reformat the published devices.json/ports.json.
+    with open(file_name, 'w', encoding='utf8') as fh:
+        fh.write(json.dumps(obj, indent=2, sort_keys=True))
+
+
+def fetch_ports_json(url, cache):
+    """
+    Conditional download, a 304 means our cached copy is still current.
+    """
+    cached = cache.get(url)
+
+    headers = {}
+    if cached is not None and cached.get('etag') is not None:
+        headers['If-None-Match'] = cached['etag']
+
+    r = SESSION.get(url, headers=headers)
+
+    if r.status_code == 304:
+        print(f"Unchanged, using cached copy of {url}")
+        return copy.deepcopy(cached['data'])
+
+    if orjson is not None:
+        data = orjson.loads(r.content)
+    else:
+        data = r.json()
+
+    cache[url] = {
+        'etag': r.headers.get('ETag'),
+        'data': data,
+        }
+
+    ## main() tags the ports in place, hand it a copy so the cache stays the raw download.
+    return copy.deepcopy(data)
+
+
 def main():
     ports = {"ports":{}}
-    runtimes_info = {}
+    runtimes_info = collections.defaultdict(list)
+
+    cache = {}
+    if os.path.isfile(CACHE_FILE):
+        try:
+            cache = load_json(CACHE_FILE)
+        except (ValueError, OSError) as err:
+            ## The cache is only an optimization, a bad one just means a full download.
+            print(f"Ignoring unreadable {CACHE_FILE}: {err}")
+            cache = {}
 
-    with open('device_info.json', 'r') as fh:
-        device_info = json.load(fh)
+    device_info = load_json('device_info.json')
 
     devices = {}
     for device_name, cfw_info in device_info.items():
@@ -117,15 +202,20 @@ def main():
                 'name': cfw_name,
                 }
 
+    ## Download both repos at once, the downloads are network bound.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(repos)) as executor:
+        fetched = {
+            repo: executor.submit(fetch_ports_json, repos[repo], cache)
+            for repo in repos}
+
     for repo in repos:
-        r = requests.get(repos[repo])
-        portsJson = r.json()
+        portsJson = fetched[repo].result()
 
         for util_name, util_data in portsJson['utils'].items():
             if not util_name.endswith('.squashfs'):
                 continue
 
-            runtimes_info.setdefault(util_data["runtime_name"], []).append(util_data["runtime_arch"])
+            runtimes_info[util_data["runtime_name"]].append(util_data["runtime_arch"])
 
         for port in portsJson["ports"]:
             port_info = portsJson["ports"][port]
@@ -135,11 +225,12 @@ def main():
 
             ports["ports"][port] = port_info
 
-    with open("devices.json", "w", encoding="utf8") as outfile:
-        outfile.write(json.dumps(devices, indent=2, sort_keys=True))
+    dump_json(devices, "devices.json")
+    dump_json(ports, "ports.json")
 
-    with open("ports.json", "w", encoding="utf8") as outfile:
-        outfile.write(json.dumps(ports, indent=2, sort_keys=True))
+    ## Replace the cache atomically so an interrupted run cannot leave it truncated.
+    dump_json(cache, CACHE_FILE + '.tmp')
+    os.replace(CACHE_FILE + '.tmp', CACHE_FILE)
 
 
 if __name__ == '__main__':
@@ -3,12 +3,24 @@
 import functools
 import json
 import pathlib
+import random
 import re
-import urllib
-import urllib.request
+import time
+
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from pathlib import Path
 
+## One session for the whole run, keep-alive saves a TCP + TLS handshake per call.
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=8, pool_maxsize=8, max_retries=0))
+
 repos = [
     ("https://api.github.com/repos/PortsMaster/PortMaster-Releases", 10),
     ("https://api.github.com/repos/PortsMaster/PortMaster-New", 1000),
@@ -23,22 +35,47 @@ def name_cleaner(text):
     return re.sub(r'[ \.]+', '.', temp)
 
 
+RETRY_STATUS = (403, 429, 500, 502, 503)
+RETRY_ATTEMPTS = 5
+
+
+def retry_delay(headers, attempt):
+    """
+    GitHub tells us exactly how long to back off, use it when its there.
+    """
+    retry_after = headers.get('Retry-After')
+    if retry_after is not None:
+        return float(retry_after)
+
+    rate_reset = headers.get('X-RateLimit-Reset')
+    if rate_reset is not None and headers.get('X-RateLimit-Remaining') == '0':
+        return max(float(rate_reset) - time.time(), 1.0)
+
+    ## Otherwise exponential backoff with a little jitter.
+    return (2 ** attempt) * (1 + random.uniform(0, 0.5))
+
+
 def fetch_text(url):
-    try:
-        # Open the URL
-        with urllib.request.urlopen(url) as response:
-            # Read the content of the file
-            file_content = response.read()
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            response = SESSION.get(url, timeout=15)
 
-        # Decode the bytes to a string (assuming the file is in UTF-8 encoding)
-        return file_content.decode('utf-8')
+        except requests.RequestException as err:
+            print(f"Unable to download {url}: {err}")
+            return None
 
-    except urllib.error.URLError as err:
-        print(f"Unable to download {url}: {err}")
-        return None
+        if response.status_code == 200:
+            return response.text
 
-    except UnicodeDecodeError as err:
-        return None
+        if response.status_code not in RETRY_STATUS or attempt == (RETRY_ATTEMPTS - 1):
+            print(f"Unable to download {url}: HTTP {response.status_code}")
+            return None
+
+        delay = retry_delay(response.headers, attempt)
+        print(f"Retrying {url} in {delay:.1f}s ({response.status_code}).")
+        time.sleep(delay)
+
+    return None
 
 
 def fetch_json(url):
@@ -46,13 +83,17 @@ def fetch_json(url):
     if text is None:
         return None
 
+    if orjson is not None:
+        return orjson.loads(text)
+
     return json.loads(text)
 
 
 def fetch_recent_data(raw_data, repo, latest=10):
     for i in range(1, 300):
         print(f"Fetching releases page {i} of {repo}.")
-        temp_data = fetch_json(f'{repo}/releases?page={i}')
+        ## Ask for the maximum page size, a third of the requests of the default 30.
+        temp_data = fetch_json(f'{repo}/releases?page={i}&per_page=100')
 
         if temp_data is None or len(temp_data) == 0:
             break
@@ -98,8 +139,11 @@ def main():
 
     if raw_stats_json.is_file():
         print("Loaded Data.")
-        with open(raw_stats_json, 'r') as fh:
-            raw_data = json.load(fh)
+        if orjson is not None:
+            raw_data = orjson.loads(raw_stats_json.read_bytes())
+        else:
+            with open(raw_stats_json, 'r') as fh:
+                raw_data = json.load(fh)
     else:
         print("Starting Fresh.")
 
@@ -109,23 +153,29 @@ def main():
     with open(raw_stats_json, 'w') as fh:
         json.dump(raw_data, fh, indent=4)
 
-    port_stats = {
-        'ports': {
-            port_name: 0
-            for port_name in raw_data['ports']},
-        'total_downloads': 0,
-        }
+    ## Tally into locals, re-indexing port_stats per asset adds up over the full history.
+    ports_count = {
+        port_name: 0
+        for port_name in raw_data['ports']}
+    total_downloads = 0
 
+    ## Only walk the assets each release actually has, not every known port per release.
     for release in raw_data['releases']:
-        for port_name in raw_data['ports']:
-            port_stats['ports'][port_name] += raw_data['release_data'][release].get(
-                port_name, 0)
+        for port_name, downloads in raw_data['release_data'][release].items():
+            if port_name not in ports_count:
+                continue
+
+            ports_count[port_name] += downloads
 
             if port_name.startswith('images.') or port_name in ('portmaster.zip', 'gameinfo.zip'):
                 continue
 
-            port_stats['total_downloads'] += raw_data['release_data'][release].get(
-                port_name, 0)
+            total_downloads += downloads
+
+    port_stats = {
+        'ports': ports_count,
+        'total_downloads': total_downloads,
+        }
 
     with open(stats_json, 'w') as fh:
         json.dump(port_stats, fh, sort_keys=True, indent=4)
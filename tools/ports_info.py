@@ -6,18 +6,27 @@ import fnmatch
 import gzip
 import hashlib
 import json
+import mmap
 import os
 import pathlib
 import pprint
 import re
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
 import zipfile
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+
+from concurrent.futures import ThreadPoolExecutor
 from difflib import Differ
 from pathlib import Path
 
@@ -29,6 +38,8 @@ class HashCache():
     def __init__(self, file_name):
         self.file_name = file_name
         self._cache = dict()
+        ## analyse_ports hashes from worker threads, the counters need the lock.
+        self._stats_lock = threading.Lock()
         self._stats = {
             'hits': 0,
             'misses': 0,
@@ -40,13 +51,17 @@ class HashCache():
             self.load_cache()
 
     def _stat_file(self, file_name):
-        file_name = Path(file_name)
-        if not file_name.is_file():
+        ## One stat syscall instead of is_file() followed by stat().
+        try:
+            st = os.stat(file_name)
+        except OSError:
+            return None
+
+        if not stat.S_ISREG(st.st_mode):
             return None
 
-        stat = Path(file_name).stat()
         return ':'.join([
-            str(getattr(stat, attr, None))
+            str(getattr(st, attr, None))
             for attr in self.CACHE_ATTRS])
 
     def load_cache(self):
@@ -58,8 +73,7 @@ class HashCache():
             'new': 0,
             }
 
-        with open(self.file_name, 'r') as fh:
-            data = json.load(fh)
+        data = load_json(self.file_name)
 
         invalidated = 0
         cache_items = 0
@@ -100,8 +114,12 @@ class HashCache():
             print(f"- total cache size: {len(self._cache)}")
             print("")
 
-        with open(self.file_name, 'w') as fh:
-            json.dump(self._cache, fh, indent=2)
+        if orjson is not None:
+            data = orjson.dumps(self._cache, option=orjson.OPT_INDENT_2)
+        else:
+            data = json.dumps(self._cache, indent=2)
+
+        write_file_atomic(self.file_name, data)
 
     def get_file_hash(self, file_name):
         file_name = str(file_name)
@@ -109,14 +127,17 @@ class HashCache():
 
         if file_name in self._cache:
             if self._cache[file_name][0] == stat:
-                self._stats['hits'] += 1
+                with self._stats_lock:
+                    self._stats['hits'] += 1
                 return self._cache[file_name][1]
 
             else:
-                self._stats['misses'] += 1
+                with self._stats_lock:
+                    self._stats['misses'] += 1
 
         else:
-            self._stats['new'] += 1
+            with self._stats_lock:
+                self._stats['new'] += 1
 
         file_hash = hash_file(file_name)
         self._cache[file_name] = [stat, file_hash]
@@ -124,43 +145,48 @@ class HashCache():
         return file_hash
 
 
-def custom_json_indent(obj, level=0, indent=4, sort_keys=True, max_length=80):
-    if sort_keys is True:
-        sort_fnc = lambda x: sorted(x, key=lambda y: y[0].lower())
-    else:
-        sort_fnc = lambda x: x
+def _ci_sort_key(item):
+    return item[0].lower()
+
 
+def custom_json_indent(obj, level=0, indent=4, sort_keys=True, max_length=80):
     """
     Custom function to indent JSON structure, but combine lines for elements with only a few or short items.
     """
     # Check if obj is a list or dict
     if isinstance(obj, list):
+        # Render each element once, both the one-line and multi-line layouts reuse them.
+        parts = [
+            custom_json_indent(item, level=level + 1, indent=indent, sort_keys=sort_keys, max_length=max_length)
+            for item in obj]
         # If obj is a list, join its elements with commas and no spaces
-        items = ", ".join([custom_json_indent(item, level=level + 1, indent=indent, sort_keys=sort_keys, max_length=max_length) for item in obj])
+        items = ", ".join(parts)
         # If the list fits on a single line, return it on one line
         if len(items) <= (max_length - (indent * level) - 2):
             return f"[{items}]"
         # If the list spans multiple lines, indent it and add newlines
         else:
             indent_str = "\n" + (" " * (level * indent))
-            items = ("," + indent_str).join([custom_json_indent(item, level=level + 1, indent=indent, sort_keys=sort_keys, max_length=max_length) for item in obj])
+            items = ("," + indent_str).join(parts)
             return f"[{indent_str}{items}{indent_str[:-indent]}]"
     elif isinstance(obj, dict):
+        obj_items = obj.items()
+        if sort_keys is True:
+            obj_items = sorted(obj_items, key=_ci_sort_key)
+
         # If obj is a dict, indent its keys and values and join them with commas and newlines
-        items = ",".join([
+        parts = [
             f"{json.dumps(k)}: {custom_json_indent(v, level=level + 1, indent=indent, sort_keys=sort_keys, max_length=max_length)}"
-            for k, v in sort_fnc(obj.items())
-            ])
+            for k, v in obj_items
+            ]
+        items = ",".join(parts)
         # If the dict fits on a single line, return it on one line
         if len(items) <= (max_length - (indent * level) - 2):
             return f"{{{items.strip()}}}"
         # If the dict spans multiple lines, indent it and add newlines
         else:
             indent_str = "\n" + (" " * (level * indent))
-            items = ("," + indent_str).join([
-                f"{json.dumps(k, sort_keys=sort_keys)}: {custom_json_indent(v, level=level + 1, indent=indent, sort_keys=sort_keys, max_length=max_length)}"
-                for k, v in sort_fnc(obj.items())
-                ])
+            items = ("," + indent_str).join(parts)
             return f"{{{indent_str}{items}{indent_str[:-indent]}}}"
     else:
         # If obj is not a list or dict, return its JSON representation
@@ -172,6 +198,37 @@ The scripts purpose is to analyse portmaster and build up enough information to
 If a port has a port.json in it, it will load it.
 """
 
+def load_json(file_name):
+    if orjson is not None:
+        with open(file_name, 'rb') as fh:
+            try:
+                ## Parse straight out of the page cache instead of copying into a bytes object.
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return orjson.loads(memoryview(mm))
+
+            except ValueError:
+                ## Empty files cannot be mmapped.
+                return orjson.loads(fh.read())
+
+    with open(file_name, 'r') as fh:
+        return json.load(fh)
+
+
+def write_file_atomic(file_name, data):
+    """
+    Write beside the target then os.replace into place, a failed or
+    interrupted write never clobbers the existing file.
+    """
+    file_name = Path(file_name)
+    tmp_name = file_name.with_name(file_name.name + '.tmp')
+
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with open(tmp_name, mode) as fh:
+        fh.write(data)
+
+    os.replace(tmp_name, file_name)
+
+
 def hash_file(file):
     md5 = hashlib.md5()
     with open(file, 'rb') as fh:
@@ -329,6 +386,11 @@ class PortInfo():
     def __repr__(self):
         return str(self.to_dict())
 
+## Compiled once, clean_name runs for every zip in every commit git_rewind visits.
+CLEAN_NAME_RE = re.compile(r'[^a-zA-Z0-9, _\-\.]+')
+SQUASH_DOTS_RE = re.compile(r'[ \.]+')
+
+
 def clean_name(file_name, attr='name'):
     if attr == 'name':
         name = file_name.name
@@ -339,8 +401,8 @@ def clean_name(file_name, attr='name'):
     else:
         name = str(file_name)
 
-    name = re.sub(r'[^a-zA-Z0-9, _\-\.]+', '', name.strip().lower())
-    return re.sub(r'[ \.]+', '.', name)
+    name = CLEAN_NAME_RE.sub('', name.strip().lower())
+    return SQUASH_DOTS_RE.sub('.', name)
 
 def add_nicely(base_dict, key, value):
     if key not in base_dict:
@@ -517,13 +579,18 @@ def analyse_port(file_name, all_data, state):
 
 def analyse_ports(root_path, all_data, state, hash_cache):
     # print(f"Checking {root_path}")
-    for sub_file in root_path.glob('*.zip'):
-        zip_name = clean_name(sub_file)
+    sub_files = [
+        sub_file
+        for sub_file in root_path.glob('*.zip')
+        if clean_name(sub_file) not in ('portmaster.zip', 'fallout.1.zip', 'alephone.zip')]
 
-        if zip_name in ('portmaster.zip', 'fallout.1.zip', 'alephone.zip'):
-            continue
+    ## Hashing the zips dominates here, overlap the file reads across a few threads.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        md5sums = list(executor.map(hash_cache.get_file_hash, sub_files))
+
+    for sub_file, md5sum in zip(sub_files, md5sums):
+        zip_name = clean_name(sub_file)
 
-        md5sum = hash_cache.get_file_hash(sub_file)
         if md5sum in state['seen']:
             continue
 
@@ -535,6 +602,9 @@ def analyse_ports(root_path, all_data, state, hash_cache):
         state['seen'][md5sum] = zip_name
 
 
+GIT_DATE_RE = re.compile(r'Date:\s+\w+ (\w+) (\d+) \d+:\d+:\d+ (\d+)', re.I)
+
+
 def git_rewind(root_path, all_data, state, hash_cache):
     month_to_num = {
         'jan': 1,
@@ -598,7 +668,7 @@ def git_rewind(root_path, all_data, state, hash_cache):
             continue
 
         for line in subprocess.check_output(['git', 'log', '--', sub_file.name]).decode('utf-8').split('\n'):
-            match = re.match(r'Date:\s+\w+ (\w+) (\d+) \d+:\d+:\d+ (\d+)', line, re.I)
+            match = GIT_DATE_RE.match(line)
             if not match:
                 continue
 
@@ -640,13 +710,11 @@ def main():
         }
 
     if state_file.is_file():
-        with state_file.open('rt') as fh:
-            state = json.load(fh)
+        state = load_json(state_file)
 
     if info_file.is_file():
         print("Loading port_info data.")
-        with open(info_file, 'r') as fh:
-            all_data = json.load(fh)
+        all_data = load_json(info_file)
 
     if 'md5' not in all_data:
         all_data['md5'] = {}
@@ -660,17 +728,12 @@ def main():
     git_rewind(root_path, all_data, state, hash_cache)
 
     ## Dump it using a custom json dumper.
-    with state_file.open('wt') as fh:
-        out_str = custom_json_indent(state, level=1, indent=2, sort_keys=True)
-        fh.write(out_str)
+    write_file_atomic(state_file, custom_json_indent(state, level=1, indent=2, sort_keys=True))
 
-    with info_file.open('wt') as fh:
-        out_str = custom_json_indent(all_data, level=1, indent=2, sort_keys=True)
-        fh.write(out_str)
+    write_file_atomic(info_file, custom_json_indent(all_data, level=1, indent=2, sort_keys=True))
 
     info_file_hash = hash_file(info_file)
-    with open(str(info_file) + '.md5', 'w') as fh:
-        fh.write(info_file_hash)
+    write_file_atomic(str(info_file) + '.md5', info_file_hash)
 
     hash_cache.save_cache()
 